@@ -2,6 +2,9 @@ import collections
 import itertools
 import string
 
+import numpy as np
+import torch
+
 
 def alphabet_factory():
     char_blank = "*"
@@ -28,6 +31,12 @@ class Alphabet:
         d2 = collections.OrderedDict(flipped)
         self.mapping = {**d1, **d2}
 
+        # Lookup table from byte value to label index for vectorized encoding
+        table = np.zeros(256, dtype=np.int64)
+        for char, index in d2.items():
+            table[ord(char)] = index + d2[char_blank]
+        self._table = table
+
     def __len__(self):
         return self.length
 
@@ -38,6 +47,11 @@ class Alphabet:
         else:
             return [self.mapping[i] + self.mapping[self.char_blank] for i in text]
 
+    def text_to_tensor(self, text):
+        """ Convert text to an integer tensor in one vectorized lookup """
+        codes = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+        return torch.from_numpy(self._table[codes])
+
     def int_to_text(self, labels):
         """ Use a character map and convert integer labels to an text sequence """
         if len(labels) > 0 and isinstance(labels[0], list):
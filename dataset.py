@@ -2,15 +2,25 @@ import os
 
 import torch
 import torch.nn as nn
+import torchaudio
 import torchaudio.transforms as transforms
 from torchaudio.datasets import LIBRISPEECH
 
-import numpy as np
+sample_rate = 16000
 
 
 class Normalize(nn.Module):
-    def forward(self, tensor):
-        return (tensor - tensor.mean(-1, keepdim=True)) / tensor.std(-1, keepdim=True)
+    def forward(self, tensor, lengths=None):
+        if lengths is None:
+            return (tensor - tensor.mean(-1, keepdim=True)) / tensor.std(-1, keepdim=True)
+        # Statistics over the valid frames only, so a sample's features do
+        # not depend on how much padding its batch carries
+        lengths = lengths.to(tensor.device).reshape(-1, 1, 1, 1)
+        mask = torch.arange(tensor.shape[-1], device=tensor.device) < lengths
+        n = lengths.to(tensor.dtype)
+        mean = (tensor * mask).sum(-1, keepdim=True) / n
+        var = ((tensor - mean) * mask).pow(2).sum(-1, keepdim=True) / (n - 1)
+        return (tensor - mean) / var.sqrt()
 
 
 # https://github.com/MyrtleSoftware/deepspeech/blob/master/src/deepspeech/data/preprocess.py#L73
@@ -19,58 +29,36 @@ class AddContextFrames(nn.Module):
     Args:
         n_context: Number of context frames to add to frame in the original
             signal.
-    Example:
-        >>> signal = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
-        >>> n_context = 2
-        >>> print(add_context_frames(signal, n_context))
-        [[0 0 0 0 0 0 1 2 3 4 5 6 7 8 9]
-         [0 0 0 1 2 3 4 5 6 7 8 9 0 0 0]
-         [1 2 3 4 5 6 7 8 9 0 0 0 0 0 0]]
     """
 
     def __init__(self, n_context):
         super(AddContextFrames, self).__init__()
         self.n_context = n_context
 
-    def __call__(self, signal):
+    def forward(self, signal):
         """
         Args:
-            signal: numpy ndarray with shape (steps, features).
+            signal: tensor with shape (..., features, steps).
         Returns:
-            numpy ndarray with shape:
-                (steps, features * (n_context + 1 + n_context))
+            tensor with shape:
+                (..., features * (n_context + 1 + n_context), steps)
         """
         # Pad to ensure first and last n_context frames in original signal have
         # at least n_context frames to their left and right respectively.
-        device = signal.device
-        signal = signal.cpu().squeeze(0).T
-        signal = signal.data.numpy()
-        steps, features = signal.shape
-        padding = np.zeros((self.n_context, features), dtype=signal.dtype)
-        signal = np.concatenate((padding, signal, padding))
-
         window_size = self.n_context + 1 + self.n_context
-        strided_signal = np.lib.stride_tricks.as_strided(
-            signal,
-            # Shape of the new array.
-            (steps, window_size, features),
-            # Strides of the new array (bytes to step in each dim).
-            (signal.strides[0], signal.strides[0], signal.strides[1]),
-            # Disable write to prevent accidental errors as elems share memory.
-            writeable=False)
-
-        # Flatten last dim and return a copy to permit writes.
-        strided_signal = strided_signal.reshape(steps, -1).copy()
-        strided_signal = torch.tensor(strided_signal, device=device).T.unsqueeze(0)
-        return strided_signal
+        signal = nn.functional.pad(signal, (self.n_context, self.n_context))
+        # Strided view over the window: (..., features, steps, window)
+        signal = signal.unfold(-1, window_size, 1)
+        # (..., window, features, steps); the reshape materializes the
+        # windows once instead of concatenating one slice per offset
+        signal = signal.movedim(-1, -3)
+        return signal.reshape(*signal.shape[:-3], -1, signal.shape[-1])
 
 
 class ProcessedDataset(torch.utils.data.Dataset):
-    def __init__(self, dataset, transforms, alphabet):
+    def __init__(self, dataset, alphabet):
         self.dataset = dataset
         self.alphabet = alphabet
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.transforms = transforms.to(self.device)
 
     def __getitem__(self, item):
         item = self.dataset[item]
@@ -80,13 +68,70 @@ class ProcessedDataset(torch.utils.data.Dataset):
         return len(self.dataset)
 
     def _process(self, item):
-        transformed = item[0].to(self.device)
+        # Return the raw waveform on CPU; the training loop applies the
+        # transforms to whole batches on the device.
+        waveform = item[0]
+        target = self.alphabet.text_to_tensor(item[2].lower())
+
+        return waveform, target
 
-        transformed = self.transforms(transformed)
-        target = self.alphabet.text_to_int(item[2].lower())
-        target = torch.tensor(target, dtype=torch.long)
 
-        return transformed, target
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Yield batches of indices grouped by sample length, so every batch
+    pads to roughly its own length instead of the longest utterance in a
+    random draw. Batch order is shuffled with a seed derived from the
+    epoch, so all distributed replicas agree on the split and each
+    replica takes every num_replicas-th batch.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=True,
+                 num_replicas=1, rank=0):
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches = [order[i:i + batch_size]
+                   for i in range(0, len(order), batch_size)]
+        if drop_last and batches and len(batches[-1]) < batch_size:
+            batches.pop()
+        # Keep an equal number of batches on every replica
+        self.batches = batches[:len(batches) - len(batches) % num_replicas]
+
+    def __len__(self):
+        return len(self.batches) // self.num_replicas
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.epoch)
+            order = torch.randperm(len(self.batches), generator=generator).tolist()
+        else:
+            order = list(range(len(self.batches)))
+        # Reshuffle on the next pass, identically on every replica
+        self.epoch += 1
+        for i in order[self.rank::self.num_replicas]:
+            yield self.batches[i]
+
+
+def get_waveform_lengths(dataset):
+    """Number of samples in each audio file, read from the file headers"""
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        lengths = []
+        for d in dataset.datasets:
+            lengths.extend(get_waveform_lengths(d))
+        return lengths
+    if isinstance(dataset, ProcessedDataset):
+        return get_waveform_lengths(dataset.dataset)
+    lengths = []
+    for fileid in dataset._walker:
+        speaker_id, chapter_id, _ = fileid.split("-")
+        file_audio = os.path.join(
+            dataset._path, speaker_id, chapter_id, fileid + dataset._ext_audio)
+        lengths.append(torchaudio.info(file_audio).num_frames)
+    return lengths
 
 
 def get_dataset(datadir, data_url):
@@ -97,28 +142,49 @@ def get_dataset(datadir, data_url):
     return dataset
 
 
+class Preprocess(nn.Module):
+    """Batched MFCC, context stacking, and length-aware normalization"""
+
+    def __init__(self, mfcc, context_frames, normalize):
+        super(Preprocess, self).__init__()
+        self.mfcc = mfcc
+        self.context_frames = context_frames
+        self.normalize = normalize
+
+    def forward(self, waveforms, lengths=None):
+        features = self.context_frames(self.mfcc(waveforms))
+        return self.normalize(features, lengths)
+
+
 def prepare_transformations(args):
-    sample_rate = 16000
     n_fft = int(sample_rate * args.window_length / 1000)  # 320
     hop_length = int(sample_rate * args.window_stride / 1000)  # 160
     melkwargs = dict(n_fft=n_fft, hop_length=hop_length)
-    transform = nn.Sequential(*[
-        #transforms.Spectrogram(n_fft=n_fft, hop_length=hop_length),
+    transform = Preprocess(
         transforms.MFCC(n_mfcc=args.n_mfcc, melkwargs=melkwargs),
         AddContextFrames(args.n_context),
         Normalize(),
-    ])
+    )
     return transform
 
 
+def model_length_function_factory(args):
+    """Map a raw waveform to the number of frames the transforms produce"""
+    hop_length = int(sample_rate * args.window_stride / 1000)
+
+    def model_length_function(waveform):
+        return waveform.shape[-1] // hop_length + 1
+
+    return model_length_function
+
+
 def split_dataset(args, alphabet):
-    transform = prepare_transformations(args)
     train_dataset = torch.utils.data.ConcatDataset(
-        [ProcessedDataset(get_dataset(args.datadir, ds), transform, alphabet)
+        [ProcessedDataset(get_dataset(args.datadir, ds), alphabet)
          for ds in args.train_data_urls]
     )
     val_dataset = torch.utils.data.ConcatDataset(
-        [ProcessedDataset(get_dataset(args.datadir, ds), transform, alphabet)
+        [ProcessedDataset(get_dataset(args.datadir, ds), alphabet)
          for ds in args.val_data_urls]
     )
     return train_dataset, val_dataset
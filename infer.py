@@ -6,9 +6,14 @@ import torch
 import torch.nn as nn
 
 from alphabet import alphabet_factory
-from dataset import prepare_transformations, ProcessedDataset, get_dataset
+from dataset import (
+    ProcessedDataset,
+    get_dataset,
+    model_length_function_factory,
+    prepare_transformations,
+)
 from decoders import GreedyDecoder
-from main import collate_factory, model_length_function, test_loop_fn
+from main import collate_factory, model_in_features, test_loop_fn
 from models import build_deepspeech
 
 
@@ -47,8 +52,7 @@ def main(args):
     alphabet = alphabet_factory()
     device = torch.device('cpu')
     checkpoint = torch.load('model_best.pth', map_location=device)
-    in_features = args.n_mfcc * (2 * args.n_context + 1)
-    model = build_deepspeech(in_features=in_features, num_classes=len(alphabet))
+    model = build_deepspeech(in_features=model_in_features(args), num_classes=len(alphabet))
     model.load_state_dict(checkpoint['state_dict'])
     print_size_of_model(model)
     decoder = GreedyDecoder()
@@ -60,9 +64,9 @@ def main(args):
         print_size_of_model(model)
 
     transform = prepare_transformations(args)
-    dataset = ProcessedDataset(get_dataset(args.datadir, "dev-clean"), transform, alphabet)
-    collate_fn = collate_factory(model_length_function)
-    criterion = nn.CTCLoss(blank=alphabet.mapping[alphabet.char_blank])
+    dataset = ProcessedDataset(get_dataset(args.datadir, "dev-clean"), alphabet)
+    collate_fn = collate_factory(model_length_function_factory(args))
+    criterion = nn.CTCLoss(blank=alphabet.mapping[alphabet.char_blank], zero_infinity=True)
     dataloader = torch.utils.data.DataLoader(
         dataset,
         batch_size=args.batch_size,
@@ -74,6 +78,7 @@ def main(args):
         dataloader,
         model,
         criterion,
+        transform,
         device,
         1,
         decoder,
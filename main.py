@@ -1,4 +1,5 @@
 import argparse
+import concurrent.futures
 import logging
 import os
 import shutil
@@ -8,59 +9,80 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torchaudio.datasets.utils import bg_iterator
 
 from alphabet import alphabet_factory
-from dataset import split_dataset
+from dataset import (
+    BucketBatchSampler,
+    get_waveform_lengths,
+    model_length_function_factory,
+    prepare_transformations,
+    split_dataset,
+)
 from decoders import GreedyDecoder
 from metrics import compute_wer
 from models import build_deepspeech
 
-np.random.seed(200)
-torch.manual_seed(200)
+# Shared across TPU workers; populated by spawn_main before xmp.spawn forks
+SERIAL_EXEC = None
+WRAPPED_MODEL = None
 
 
-def model_length_function(tensor):
-    return tensor.shape[0]
+def set_seed(seed):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
 
 
-def check_loss(loss, loss_value):
-    """
-    Check that warp-ctc loss is valid and will not break training
-    :return: Return if loss is valid, and the error in case it is not
-    """
-    loss_valid = True
-    error = ''
-    if loss_value == float("inf") or loss_value == float("-inf"):
-        loss_valid = False
-        error = "WARNING: received an inf loss"
-    elif torch.isnan(loss).sum() > 0:
-        loss_valid = False
-        error = 'WARNING: received a nan loss, setting loss value to 0'
-    elif loss_value < 0:
-        loss_valid = False
-        error = "WARNING: received a negative loss"
-    return loss_valid, error
+def model_in_features(args):
+    """Width of a frame once the context windows are stacked"""
+    return args.n_mfcc * (2 * args.n_context + 1)
 
 
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
 
-def save_checkpoint(state_dict, is_best, filename):
-    tempfile = filename + ".temp"
+checkpoint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+checkpoint_future = None
 
-    # Remove tempfile in case interuption during the copying from tempfile to filename
-    if os.path.isfile(tempfile):
-        os.remove(tempfile)
 
+def copy_to_cpu(obj):
+    """Snapshot tensors to host memory so a background save sees stable data"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [copy_to_cpu(value) for value in obj]
+    return obj
+
+
+def write_checkpoint(state_dict, is_best, filename):
+    tempfile = filename + ".temp"
     torch.save(state_dict, tempfile)
-    if os.path.isfile(tempfile):
-        os.rename(tempfile, filename)
+    # Atomic swap, so readers never observe a partially written checkpoint
+    os.replace(tempfile, filename)
     if is_best:
         shutil.copyfile(filename, "model_best.pth")
 
 
+def save_checkpoint(state_dict, is_best, filename):
+    global checkpoint_future
+    # Finish the previous save so writes to the same files cannot
+    # interleave, and re-raise its failure instead of dropping it
+    if checkpoint_future is not None:
+        checkpoint_future.result()
+
+    state_dict = copy_to_cpu(state_dict)
+    checkpoint_future = checkpoint_executor.submit(
+        write_checkpoint, state_dict, is_best, filename)
+
+
+def finish_checkpoint():
+    """Block until the last background save lands and surface its errors"""
+    if checkpoint_future is not None:
+        checkpoint_future.result()
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Train DeepSpeech model on TPU using librispeech dataset"
@@ -70,7 +92,13 @@ def parse_args():
     parser.add_argument(
         "--world-size", type=int, default=8, choices=[1, 8]
     )
-    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument(
+        "--num-workers", type=int, default=min(8, os.cpu_count() or 1)
+    )
+    parser.add_argument(
+        "--prefetch-factor", type=int, default=4,
+        help="Batches each worker keeps queued ahead of the training step"
+    )
     parser.add_argument("--batch-size", type=int, default=32)
     # Preprocessing args
     parser.add_argument(
@@ -92,6 +120,14 @@ def parse_args():
     parser.add_argument("--momentum", type=float, default=0.9)
     # Training args
     parser.add_argument("--num-epochs", type=int, default=1)
+    parser.add_argument(
+        "--use-amp", type=bool, default=False,
+        help="Train with mixed precision (CUDA only)"
+    )
+    parser.add_argument(
+        "--use-compile", type=bool, default=False,
+        help="Compile the model forward with torch.compile when available"
+    )
     parser.add_argument(
         "--checkpoint", default="", type=str, metavar="PATH",
         help="path to latest checkpoint",
@@ -101,10 +137,21 @@ def parse_args():
     parser.add_argument("--val-data-urls", type=str, nargs="+", default=['dev-clean'])
     parser.add_argument("--log-steps", type=int, default=100)
     parser.add_argument('--logdir', type=str, default=None)
+    parser.add_argument("--seed", type=int, default=200)
     args = parser.parse_args()
     return args
 
 
+def loader_worker_kwargs(args):
+    kwargs = dict(num_workers=args.num_workers)
+    if args.num_workers > 0:
+        # Keep workers alive across epochs and let them queue batches ahead
+        kwargs.update(
+            persistent_workers=True,
+            prefetch_factor=args.prefetch_factor)
+    return kwargs
+
+
 def collate_factory(model_length_function):
     """
     Based on
@@ -112,72 +159,167 @@ def collate_factory(model_length_function):
     """
 
     def collate_fn(batch):
-        inputs = [b[0].squeeze(0).transpose(0, 1) for b in batch]
-        input_lengths = torch.tensor(
-            [model_length_function(i) for i in inputs],
-            dtype=torch.long,
-        )
-        inputs = nn.utils.rnn.pad_sequence(inputs, batch_first=True).unsqueeze(1)
-
-        labels = [b[1] for b in batch]
-        label_lengths = torch.tensor(
-            [label.shape[0] for label in labels],
-            dtype=torch.long,
-        )
-        labels = nn.utils.rnn.pad_sequence(labels, batch_first=True)
+        batch_size = len(batch)
+        # Fill the length tensors directly instead of going through Python
+        # lists; int32 is what the cuDNN CTC kernel expects for lengths
+        input_lengths = torch.empty(batch_size, dtype=torch.int32)
+        label_lengths = torch.empty(batch_size, dtype=torch.int32)
+        max_waveform = 0
+        max_label = 0
+        for i, (waveform, label) in enumerate(batch):
+            input_lengths[i] = model_length_function(waveform)
+            label_lengths[i] = label.shape[0]
+            max_waveform = max(max_waveform, waveform.shape[-1])
+            max_label = max(max_label, label.shape[0])
+
+        # Copy every sample into preallocated buffers instead of building
+        # intermediate lists and padding them in a second pass.
+        inputs = torch.zeros(batch_size, 1, max_waveform)
+        labels = torch.zeros(batch_size, max_label, dtype=torch.long)
+        for i, (waveform, label) in enumerate(batch):
+            inputs[i, :, :waveform.shape[-1]].copy_(waveform)
+            labels[i, :label.shape[0]].copy_(label)
         return inputs, input_lengths, labels, label_lengths
 
     return collate_fn
 
 
+class CudaPrefetcher:
+    """
+    Wrap a DataLoader and copy the next batch to the device on a side
+    CUDA stream, so the transfer overlaps with the compute of the
+    current batch instead of running on the training stream.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        inputs, input_lengths, labels, label_lengths = batch
+        with torch.cuda.stream(self.stream):
+            # Length tensors stay on the host for CTC and sequence packing
+            return (inputs.to(self.device, non_blocking=True),
+                    input_lengths,
+                    labels.to(self.device, non_blocking=True),
+                    label_lengths)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            # Wait for the in-flight copy, then start the next one before
+            # handing the batch over to the training step
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            for t in batch:
+                if t.is_cuda:
+                    t.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._preload(iterator)
+            yield batch
+
+
 def get_optimizer(args, parameters):
     if args.optimizer == "sgd":
-        optimizer = optim.SGD(parameters, lr=args.learning_rate, momentum=args.momentum)
+        optimizer_class = optim.SGD
+        kwargs = dict(lr=args.learning_rate, momentum=args.momentum)
     elif args.optimizer == "adam":
-        optimizer = optim.Adam(parameters, lr=args.learning_rate)
+        optimizer_class = optim.Adam
+        kwargs = dict(lr=args.learning_rate)
     else:
         raise ValueError(f"Invalid choice: {args.optimizer}")
-    return optimizer
+
+    if torch.cuda.is_available():
+        try:
+            # One fused kernel per step instead of one launch per parameter
+            return optimizer_class(parameters, fused=True, **kwargs)
+        except TypeError:
+            # This torch build predates the fused implementations
+            pass
+    return optimizer_class(parameters, **kwargs)
+
+
+def clip_grad_norm(parameters, max_norm):
+    try:
+        # Multi-tensor path: one norm reduction over all gradients at once
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm, foreach=True)
+    except TypeError:
+        # This torch build predates the foreach argument
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm)
+
+
+def log_batch_wer(out, labels, decoder, alphabet):
+    wers, n_words = compute_wer(out, labels, decoder, alphabet, print_output=True)
+    batch_wer = wers / n_words
+    logging.info('Batch WER: %.3f', batch_wer)
+
+
+def check_wer_future(future):
+    # Surface failures from the worker thread instead of dropping them
+    if future.exception() is not None:
+        logging.error('Batch WER logging failed', exc_info=future.exception())
 
 
 def train_loop_fn(loader,
                   optimizer,
+                  scaler,
                   model,
                   criterion,
+                  transform,
                   device,
                   epoch,
                   decoder,
                   alphabet,
                   log_steps):
     running_loss = 0.0
-    iteration = 0
+    # Decoding and WER are host-side work; run them on a worker thread so
+    # the device-to-host copy and the Levenshtein loop do not stall training
+    wer_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
     model.train()
     for step, (inputs, input_lengths, labels, label_lengths) in enumerate(loader, 1):
+        if device.type == 'cuda':
+            # Asynchronous copy from pinned memory overlaps with compute;
+            # lengths stay on the host for CTC and sequence packing
+            inputs = inputs.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+        # Transform the whole batch of waveforms on the device
+        # (batch, channel, feature, time) -> (batch, channel, time, feature)
+        inputs = transform(inputs, input_lengths).transpose(2, 3)
+        # Packing has no XLA lowering; keep the dense path there
+        lengths = input_lengths if device.type != 'xla' else None
         # zero the parameter gradients
         optimizer.zero_grad()
-        out = model(inputs)
-
-        loss = criterion(out, labels, input_lengths, label_lengths)
-        loss_value = loss.item()
-        # Check to ensure valid loss was calculated
-        valid_loss, error = check_loss(loss, loss_value)
-        if valid_loss:
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 400)
-            optimizer.step()
-        else:
-            logging.error(error)
-            logging.info('Skipping grad update')
-            loss_value = 0
+        with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+            out = model(inputs, lengths)
+            loss = criterion(out, labels, input_lengths, label_lengths)
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        clip_grad_norm(model.parameters(), 400)
+        scaler.step(optimizer)
+        scaler.update()
 
-        iteration += 1
-        running_loss += loss_value
+        running_loss += loss.detach()
         if step % log_steps == 0:
-            wers, n_words = compute_wer(out, labels, decoder, alphabet, print_output=True)
-            batch_wer = wers / n_words
-            logging.info('Batch WER: %.3f', batch_wer)
-
-    avg_loss = running_loss / iteration
+            if device.type == 'cuda':
+                future = wer_executor.submit(
+                    log_batch_wer, out.detach(), labels, decoder, alphabet)
+                future.add_done_callback(check_wer_future)
+            else:
+                # On XLA a concurrent .to("cpu") would force graph execution
+                # while the main thread traces the next step
+                log_batch_wer(out.detach(), labels, decoder, alphabet)
+
+    wer_executor.shutdown(wait=True)
+    # Single host sync for the whole epoch
+    avg_loss = float(running_loss) / step
     logging.info('[Train][%s] Loss=%.5f Time=%s',
                  epoch, avg_loss, time.asctime())
 
@@ -185,6 +327,7 @@ def train_loop_fn(loader,
 def test_loop_fn(loader,
                  model,
                  criterion,
+                 transform,
                  device,
                  epoch,
                  decoder,
@@ -192,21 +335,24 @@ def test_loop_fn(loader,
     running_loss = 0.0
     total_words = 0
     cumulative_wer = 0
-    iteration = 0
 
     model.eval()
     with torch.no_grad():
-        for inputs, input_lengths, labels, label_lengths in loader:
-            out = model(inputs)
+        for step, (inputs, input_lengths, labels, label_lengths) in enumerate(loader, 1):
+            if device.type == 'cuda':
+                inputs = inputs.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+            inputs = transform(inputs, input_lengths).transpose(2, 3)
+            lengths = input_lengths if device.type != 'xla' else None
+            out = model(inputs, lengths)
             loss = criterion(out, labels, input_lengths, label_lengths)
 
-            iteration += 1
-            running_loss += loss.item()
+            running_loss += loss.detach()
             wers, n_words = compute_wer(out, labels, decoder, alphabet, print_output=True)
             cumulative_wer += wers
             total_words += n_words
 
-        avg_loss = running_loss / iteration
+        avg_loss = float(running_loss) / step
         avg_wer = cumulative_wer / total_words
         logging.info('[Val][%s] Loss=%.5f WER=%.3f Time=%s',
                      epoch, avg_loss, avg_wer, time.asctime())
@@ -214,47 +360,44 @@ def test_loop_fn(loader,
 
 
 def _main_xla(index, args):
-    import torch_xla
     import torch_xla.core.xla_model as xm
-    import torch_xla.debug.metrics as met
     import torch_xla.distributed.parallel_loader as pl
 
+    set_seed(args.seed)
     alphabet = alphabet_factory()
-    train_dataset, test_dataset = split_dataset(args, alphabet)
-    collate_fn = collate_factory(model_length_function)
-    if xm.xrt_world_size() > 1:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(
-            train_dataset,
-            num_replicas=xm.xrt_world_size(),
-            rank=xm.get_ordinal(),
-            shuffle=True)
-    else:
-        train_sampler = torch.utils.data.RandomSampler(train_dataset)
+    # Download and build the datasets one worker at a time
+    train_dataset, test_dataset = SERIAL_EXEC.run(lambda: split_dataset(args, alphabet))
+    collate_fn = collate_factory(model_length_function_factory(args))
+    # Batches of similar length keep padding waste low and XLA graphs uniform
+    train_sampler = BucketBatchSampler(
+        get_waveform_lengths(train_dataset),
+        args.batch_size,
+        shuffle=True,
+        num_replicas=xm.xrt_world_size(),
+        rank=xm.get_ordinal())
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=args.batch_size,
-        sampler=train_sampler,
-        num_workers=args.num_workers,
+        batch_sampler=train_sampler,
         collate_fn=collate_fn,
-        drop_last=True)
+        **loader_worker_kwargs(args))
     test_loader = torch.utils.data.DataLoader(
         test_dataset,
         batch_size=args.batch_size,
         shuffle=False,
-        num_workers=args.num_workers,
         collate_fn=collate_fn,
-        drop_last=True)
+        drop_last=True,
+        **loader_worker_kwargs(args))
 
     # Scale learning rate to world size
     lr = args.learning_rate * xm.xrt_world_size()
 
     # Get loss function, optimizer, and model
     device = xm.xla_device()
-    model = build_deepspeech(in_features=in_features, num_classes=len(alphabet))
-    model = model.to(device)
+    model = WRAPPED_MODEL.to(device)
+    transform = prepare_transformations(args).to(device)
     optimizer = get_optimizer(args, model.parameters())
-    criterion = nn.CTCLoss(blank=alphabet.mapping[alphabet.char_blank])
+    criterion = nn.CTCLoss(blank=alphabet.mapping[alphabet.char_blank], zero_infinity=True)
     decoder = GreedyDecoder()
 
     train_device_loader = pl.MpDeviceLoader(train_loader, device)
@@ -276,56 +419,76 @@ def _main_xla(index, args):
             xm.optimizer_step(self.optimizer)
 
     optimizer = XLAProxyOptimizer(optimizer)
+    scaler = torch.cuda.amp.GradScaler(enabled=False)
 
     train_eval_fn(args.num_epochs,
                   train_device_loader,
                   test_device_loader,
                   optimizer,
+                  scaler,
                   model,
                   criterion,
+                  transform,
                   device,
                   decoder,
                   alphabet,
-                  args.checkpoint)
+                  args.checkpoint,
+                  args.log_steps)
 
 
 def main(index, args):
+    set_seed(args.seed)
     alphabet = alphabet_factory()
     train_dataset, test_dataset = split_dataset(args, alphabet)
-    collate_fn = collate_factory(model_length_function)
+    collate_fn = collate_factory(model_length_function_factory(args))
 
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    in_features = model_in_features(args)
+    train_sampler = BucketBatchSampler(
+        get_waveform_lengths(train_dataset),
+        args.batch_size,
+        shuffle=True)
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        #pin_memory=True,
-        shuffle=True,
+        batch_sampler=train_sampler,
+        pin_memory=device.type == 'cuda',
         collate_fn=collate_fn,
-        drop_last=True)
+        **loader_worker_kwargs(args))
     test_loader = torch.utils.data.DataLoader(
         test_dataset,
-        num_workers=args.num_workers,
         batch_size=args.batch_size,
         shuffle=False,
+        pin_memory=device.type == 'cuda',
         collate_fn=collate_fn,
-        drop_last=True)
+        drop_last=True,
+        **loader_worker_kwargs(args))
+    if device.type == 'cuda':
+        train_loader = CudaPrefetcher(train_loader, device)
+        test_loader = CudaPrefetcher(test_loader, device)
 
     # Get loss function, optimizer, and model
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    in_features = args.n_mfcc * (2 * args.n_context + 1)
     model = build_deepspeech(in_features=in_features, num_classes=len(alphabet))
     model = model.to(device)
+    if args.use_compile:
+        if hasattr(torch, "compile"):
+            model = torch.compile(model)
+        else:
+            logging.warning("torch.compile not available in this torch build")
+    transform = prepare_transformations(args).to(device)
     logging.info("Number of parameters: %s", count_parameters(model))
 
     optimizer = get_optimizer(args, model.parameters())
-    criterion = nn.CTCLoss(blank=alphabet.mapping[alphabet.char_blank])
+    scaler = torch.cuda.amp.GradScaler(enabled=args.use_amp and device.type == 'cuda')
+    criterion = nn.CTCLoss(blank=alphabet.mapping[alphabet.char_blank], zero_infinity=True)
     decoder = GreedyDecoder()
     train_eval_fn(args.num_epochs,
                   train_loader,
                   test_loader,
                   optimizer,
+                  scaler,
                   model,
                   criterion,
+                  transform,
                   device,
                   decoder,
                   alphabet,
@@ -337,8 +500,10 @@ def train_eval_fn(num_epochs,
                   train_loader,
                   test_loader,
                   optimizer,
+                  scaler,
                   model,
                   criterion,
+                  transform,
                   device,
                   decoder,
                   alphabet,
@@ -350,8 +515,10 @@ def train_eval_fn(num_epochs,
         logging.info("Epoch: %s at %s", epoch, time.asctime())
         train_loop_fn(train_loader,
                       optimizer,
+                      scaler,
                       model,
                       criterion,
+                      transform,
                       device,
                       epoch,
                       decoder,
@@ -360,6 +527,7 @@ def train_eval_fn(num_epochs,
         loss = test_loop_fn(test_loader,
                             model,
                             criterion,
+                            transform,
                             device,
                             epoch,
                             decoder,
@@ -374,12 +542,25 @@ def train_eval_fn(num_epochs,
         }
         save_checkpoint(state_dict, is_best, checkpoint)
         logging.info("End epoch: %s at %s", epoch, time.asctime())
+    finish_checkpoint()
 
 
 def spawn_main(main, args):
     if args.use_tpu:
         import torch_xla.distributed.xla_multiprocessing as xmp
-        xmp.spawn(_main_xla, args=(args,), nprocs=args.world_size)
+
+        global SERIAL_EXEC, WRAPPED_MODEL
+        # Build the model once in the parent process so all workers share
+        # a single host copy of the weights instead of allocating their own
+        alphabet = alphabet_factory()
+        SERIAL_EXEC = xmp.MpSerialExecutor()
+        WRAPPED_MODEL = xmp.MpModelWrapper(
+            build_deepspeech(in_features=model_in_features(args),
+                             num_classes=len(alphabet)))
+        # Workers must be forked so they inherit the populated globals;
+        # MpModelWrapper requires the fork start method as well
+        xmp.spawn(_main_xla, args=(args,), nprocs=args.world_size,
+                  start_method='fork')
     else:
         main(0, args)
 
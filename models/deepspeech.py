@@ -1,3 +1,5 @@
+from typing import Optional
+
 import torch
 import torch.nn as nn
 
@@ -57,8 +59,13 @@ class DeepSpeech(nn.Module):
                  dropout: float = 0.0) -> None:
         super(DeepSpeech, self).__init__()
         self.hidden_size = hidden_size
+        # Round the input width up to a multiple of 8 so the first matmul
+        # meets Tensor Core / MXU alignment; forward zero-pads to match.
+        # hidden_size (2048) is already aligned.
+        padded_in_features = (in_features + 7) // 8 * 8
+        self.feature_padding = padded_in_features - in_features
         # The first three layers are not recurrent
-        self.fc1 = FullyConnected(in_features, hidden_size, dropout)
+        self.fc1 = FullyConnected(padded_in_features, hidden_size, dropout)
         self.fc2 = FullyConnected(hidden_size, hidden_size, dropout)
         self.fc3 = FullyConnected(hidden_size, hidden_size, dropout)
         # The fourth layer is a bi-directional recurrent layer
@@ -74,8 +81,10 @@ class DeepSpeech(nn.Module):
             nn.LogSoftmax(dim=2)
         ])
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
         # N x C x T x F
+        if self.feature_padding:
+            x = nn.functional.pad(x, (0, self.feature_padding))
         x = self.fc1(x)
         # N x C x T x H
         x = self.fc2(x)
@@ -86,7 +95,16 @@ class DeepSpeech(nn.Module):
         # N x T x H
         x = x.transpose(0, 1)
         # T x N x H
-        x, _ = self.bi_rnn(x)
+        if lengths is not None:
+            # Pack so the RNN skips compute on padding time steps
+            total_length = x.shape[0]
+            x = nn.utils.rnn.pack_padded_sequence(
+                x, lengths.cpu(), enforce_sorted=False)
+            x, _ = self.bi_rnn(x)
+            x, _ = nn.utils.rnn.pad_packed_sequence(
+                x, total_length=total_length)
+        else:
+            x, _ = self.bi_rnn(x)
         # The fifth (non-recurrent) layer takes both the forward and backward units as inputs
         x = x[:, :, :self.hidden_size] + x[:, :, self.hidden_size:]
         # T x N x H